@@ -21,6 +21,7 @@
 
 import os
 import sys
+import re
 import argparse
 import json
 import subprocess
@@ -29,30 +30,71 @@ import tempfile
 import grako.buffering
 import grako.exceptions
 
+try:
+    import orjson # optional, faster json decoder
+except ImportError:
+    orjson = None
+
 from . import template
 from . import printer
 from . import parser
 
+# Caml-style comment delimiters
+COMMENT_DELIMITER = re.compile (r"\(\*|\*\)")
+
+# Integers of 19 digits or more may not fit in 64 bits (negative ones below -2^63)
+LONG_INTEGER = re.compile (r"\d{19}")
+
+def load_json (text):
+    """
+    Decode json data text, with orjson if available.
+    orjson is stricter than json : it rejects NaN/Infinity, and may not decode integers above 64 bits exactly.
+    These inputs are decoded with json instead.
+    """
+    if orjson is not None and not LONG_INTEGER.search (text):
+        try: return orjson.loads (text)
+        except orjson.JSONDecodeError: pass
+    return json.loads (text)
+
 class CubicleBuffer (grako.buffering.Buffer):
     """
     Grako Buffer subclass used to remove the caml-style recursive comments in cubicle.
+    Comments are located once for the whole text when the buffer is created.
     """
+    def __init__ (self, text, **kwargs):
+        super ().__init__ (text, **kwargs)
+        self.comment_ends = self.locate_comments ()
+
+    def locate_comments (self):
+        """
+        Scan the whole text for comments, in a single pass over the comment delimiters.
+        Returns a dict mapping the start position of each top-level comment to its end position.
+        """
+        comment_ends = {}
+        level = 0
+        pos = 0
+        for delimiter in COMMENT_DELIMITER.finditer (self.text):
+            pos = delimiter.end ()
+            if delimiter.group () == "(*":
+                if level == 0:
+                    start = delimiter.start ()
+                level += 1
+            elif level > 0:
+                level -= 1
+                if level == 0:
+                    comment_ends[start] = pos
+        if level > 0:
+            raise grako.exceptions.ParseError ("Unmatched comment at line {}".format (self.line_info (pos).line + 1))
+        return comment_ends
+
     def eat_comments (self):
         """
         Override the grako eat_comments function.
         Removes comments starting at current buffer position.
         """
-        if self.match ("(*"):
-            level = 1
-            while level > 0:
-                matched = self._scanre ("(?:.|\n)*?(\(\*|\*\))") # match next '(*' or '*)'
-                if not matched:
-                    raise grako.exceptions.ParseError ("Unmatched comment at line {}".format (self.line_info ().line + 1))
-                if matched.group (1) == "(*":
-                    level += 1
-                if matched.group (1) == "*)":
-                    level -= 1
-                self.move (len (matched.group (0)))
+        end = self.comment_ends.get (self.pos)
+        if end is not None:
+            self.goto (end)
 
 class Compiler:
     """
@@ -90,6 +132,8 @@ class CompilerOutput:
     * a temporary file, destroyed at end of script
     * stdout, untouched
     """
+    __slots__ = ("obj", "name", "is_tmp")
+
     def __init__ (self, file_obj, name = None, is_tmp = False):
         self.obj = file_obj
         self.name = name
@@ -109,7 +153,13 @@ class CompilerOutput:
         return CompilerOutput (sys.stdout)
     @staticmethod
     def from_tempfile ():
-        fd, filename = tempfile.mkstemp (suffix = ".cub")
+        # Use a memory-backed directory if available ; the file is only read back once by cubicle
+        # A user-chosen temporary directory takes precedence (/dev/shm may be small, e.g. in containers)
+        user_tmp_dir = (any (var in os.environ for var in ("TMPDIR", "TEMP", "TMP")) or
+                tempfile.tempdir not in (None, "/tmp"))
+        if user_tmp_dir or not os.access ("/dev/shm", os.W_OK): tmp_dir = None
+        else: tmp_dir = "/dev/shm"
+        fd, filename = tempfile.mkstemp (suffix = ".cub", dir = tmp_dir)
         return CompilerOutput (open (fd, "w"), filename, is_tmp = True)
 
 def main ():
@@ -142,7 +192,7 @@ def main ():
     # Load data
     data = {}
     if args.data:
-        data = json.load (args.data)
+        data = load_json (args.data.read ())
 
     # Load AST
     compiler = Compiler (args.file)
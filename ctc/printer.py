@@ -24,8 +24,11 @@ class CommonExprPrinter:
     Collections of printer functions for expression AST nodes that are independent of expansion.
     These functions take an AST node, and recursively compute the string representation of it.
     """
+    __slots__ = ()
+
     def array (self, a):
-        return "{}[{}]".format (self.name (a.name), ", ".join (map (self.name, a.index)))
+        name = self.name
+        return f"{name (a.name)}[{', '.join ([name (i) for i in a.index])}]"
     def ref (self, s):
         if s.array is not None: return self.array (s.array)
         if s.var is not None: return self.name (s.var.name)
@@ -34,62 +37,68 @@ class CommonExprPrinter:
         if v.const is not None: return v.const
     def expr (self, e):
         if e.val is not None: return self.rvalue (e.val)
-        if e.op is not None: return "{} {} {}".format (self.rvalue (e.lhs), e.op, self.rvalue (e.rhs))
+        if e.op is not None: return f"{self.rvalue (e.lhs)} {e.op} {self.rvalue (e.rhs)}"
     def comp_expr (self, c):
-        return "{} {} {}".format (self.expr (c.lhs), c.op, self.expr (c.rhs))
+        return f"{self.expr (c.lhs)} {c.op} {self.expr (c.rhs)}"
     def forall_expr (self, f):
-        if f.comp is not None: return "forall_other {}. {}".format (f.proc, self.comp_expr (f.comp))
-        if f.expr is not None: return "forall_other {}. ({})".format (f.proc, self.or_expr (f.expr))
+        if f.comp is not None: return f"forall_other {f.proc}. {self.comp_expr (f.comp)}"
+        if f.expr is not None: return f"forall_other {f.proc}. ({self.or_expr (f.expr)})"
     def bool_expr (self, e):
         if e.forall is not None: return self.forall_expr (e.forall)
         if e.comp is not None: return self.comp_expr (e.comp)
     
     def and_expr (self, a):
         """ An AND expression is a list of AND elements, with && operators in between. """
-        return " && ".join (map (self.and_elem, a))
+        and_elem = self.and_elem
+        return " && ".join ([and_elem (e) for e in a])
     def or_expr (self, o):
         """ An OR expression is a list of OR elements, with || operators in between. """
-        return " || ".join (map (self.or_elem, o))
+        or_elem = self.or_elem
+        return " || ".join ([or_elem (e) for e in o])
 
 class TemplateExprPrinter (CommonExprPrinter):
     """
     Collections of printer functions for expression AST nodes before expansion (with templates statements).
     These functions complete the ones in CommonExprPrinter to support all unexpanded AST expressions.
     """
+    __slots__ = ()
+
     def template (self, t):
         """ A template element. """
         if t.arg is not None: return t.arg
         if t.key_ref is not None: return t.key_ref
-        if t.field_ref is not None: return "{}.{}".format (t.field_ref.key, t.field_ref.field)
+        if t.field_ref is not None: return f"{t.field_ref.key}.{t.field_ref.field}"
     def template_args (self, a):
-        return ", ".join (map (self.template, a))
+        template = self.template
+        return ", ".join ([template (t) for t in a])
     def template_decl (self, d):
         """ Unexpanded : template declarations are present in statements and template iterators. """
         if d.cond is not None:
-            return "@{} | {}@".format (self.template_args (d.args), self.or_expr (d.cond))
-        else: return "@{}@".format (self.template_args (d.args))
+            return f"@{self.template_args (d.args)} | {self.or_expr (d.cond)}@"
+        else: return f"@{self.template_args (d.args)}@"
     def name (self, n):
         """ Unexpanded : names are interleaved lists of name parts and template elements. """
-        name_parts = n[:]
-        name_parts[1::2] = map (self.template, name_parts[1::2])
-        return "@".join (name_parts)
+        template = self.template
+        return "@".join ([part if i % 2 == 0 else template (part) for i, part in enumerate (n)])
     def and_elem (self, e):
         """ Unexpanded : AND elements can be boolean expressions, template AND iterators, or nested OR expression. """
         if e.expr is not None: return self.bool_expr (e.expr)
-        if e.template is not None: return "{} (&& {})".format (
-                self.template_decl (e.template.decl), self.and_expr (e.template.expr))
-        if e.or_expr is not None: return "({})".format (self.or_expr (e.or_expr))
+        if e.template is not None:
+            return f"{self.template_decl (e.template.decl)} (&& {self.and_expr (e.template.expr)})"
+        if e.or_expr is not None: return f"({self.or_expr (e.or_expr)})"
     def or_elem (self, e):
         """ Unexpanded : OR elements can be AND expressions, or template OR iterators. """
         if e.expr is not None: return self.and_expr (e.expr)
-        if e.template is not None: return "{} (|| {})".format (
-                self.template_decl (e.template.decl), self.and_expr (e.template.expr))
+        if e.template is not None:
+            return f"{self.template_decl (e.template.decl)} (|| {self.and_expr (e.template.expr)})"
 
 class ExpandedExprPrinter (CommonExprPrinter):
     """
     Collections of printer functions for expression AST nodes after expansion (without template statements).
     These functions complete the ones in CommonExprPrinter to support all expanded AST expressions.
     """
+    __slots__ = ()
+
     def name (self, n):
         """ Expanded : names are simple strings. """
         return n
@@ -104,48 +113,61 @@ class ExpandedAstPrinter (ExpandedExprPrinter):
     """
     Complete printer for expanded AST.
     """
+    __slots__ = ()
+
+    def transition (self, t):
+        """ Returns the string representation of an expanded transition (multiple lines). """
+        out = []
+        append = out.append
+        ref, expr, and_expr = self.ref, self.expr, self.and_expr
+        append (f"transition {t.name} ({' '.join (t.procs)})\n")
+        if t.require is not None:
+            append (f"\trequires {{ {self.or_expr (t.require)} }}\n")
+        append ("{\n")
+        for u in t.updates:
+            lhs = ref (u.lhs)
+            if u.rhs.switch is not None:
+                append (f"\t{lhs} := case\n")
+                for c in u.rhs.switch:
+                    if c.cond == "_":
+                        append (f"\t\t| _ : {expr (c.expr)}\n")
+                    else:
+                        append (f"\t\t| {and_expr (c.cond)} : {expr (c.expr)}\n")
+                append ("\t;\n")
+            if u.rhs.expr is not None:
+                append (f"\t{lhs} := {expr (u.rhs.expr)};\n")
+            if u.rhs.rand is not None:
+                append (f"\t{lhs} := ?;\n")
+        append ("}\n")
+        return "".join (out)
+
+    def proc_expr_construct (self, s, name):
+        """ Common printer for init, unsafe, invariant constructs (they have a similar structure). """
+        return f"{name} ({' '.join (s.procs)}) {{ {self.or_expr (s.expr)} }}\n"
+
     def write (self, stream, ast):
         """
         Print string representation of expanded AST ast in stream file-like object.
-        Relies in ExpandedExprPrinter functions, but is a single big function (not modular).
+        Relies in ExpandedExprPrinter functions ; transitions are printed by transition ().
+        Output lines are accumulated and written to the stream in one call.
         """
-        def line (fmt, *args):
-            stream.write (fmt.format (*args) + "\n")
-        def line_proc_expr_construct (s, name):
-            """ Common printer for init, unsafe, invariant constructs (they have a similar structure). """
-            line ("{} ({}) {{ {} }}", name, " ".join (s.procs), self.or_expr (s.expr))
+        out = []
+        append = out.append
+        ref, proc_expr_construct = self.ref, self.proc_expr_construct
 
         if ast.size_proc is not None:
-            line ("number_procs {}", ast.size_proc)
+            append (f"number_procs {ast.size_proc}\n")
         for t in ast.types:
             if t.enum is not None:
-                line ("type {} = {}", t.name, " | ".join (t.enum));
+                append (f"type {t.name} = {' | '.join (t.enum)}\n")
             else:
-                line ("type {}", t.name)
+                append (f"type {t.name}\n")
         for d in ast.decls:
-            line ("{} {} : {}", d.kind, self.ref (d.name), d.typename)
-        line_proc_expr_construct (ast.init, "init")
+            append (f"{d.kind} {ref (d.name)} : {d.typename}\n")
+        append (proc_expr_construct (ast.init, "init"))
         for i in ast.invariants:
-            line_proc_expr_construct (i, "invariant")
+            append (proc_expr_construct (i, "invariant"))
         for u in ast.unsafes:
-            line_proc_expr_construct (u, "unsafe")
-        for t in ast.transitions:
-            line ("transition {} ({})", t.name, " ".join (t.procs))
-            if t.require is not None:
-                line ("\trequires {{ {} }}", self.or_expr (t.require))
-            line ("{{")
-            for u in t.updates:
-                if u.rhs.switch is not None:
-                    line ("\t{} := case", self.ref (u.lhs))
-                    for c in u.rhs.switch:
-                        if c.cond == "_":
-                            line ("\t\t| _ : {}", self.expr (c.expr))
-                        else:
-                            line ("\t\t| {} : {}", self.and_expr (c.cond), self.expr (c.expr))
-                    line ("\t;")
-                if u.rhs.expr is not None:
-                    line ("\t{} := {};", self.ref (u.lhs), self.expr (u.rhs.expr))
-                if u.rhs.rand is not None:
-                    line ("\t{} := ?;", self.ref (u.lhs))
-            line ("}}")
-
+            append (proc_expr_construct (u, "unsafe"))
+        out.extend (map (self.transition, ast.transitions))
+        stream.write ("".join (out))
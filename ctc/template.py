@@ -19,17 +19,18 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import re
-import collections
+import sys
+import copy
+import collections.abc
 import operator
 import itertools
 
-import grako.ast
-
 from .printer import TemplateExprPrinter
 
 # Utils
-NAME_FORMAT = re.compile ("^[A-Za-z][A-Za-z0-9_]*$")
+def valid_name (name):
+    """ Checks that a name matches [A-Za-z][A-Za-z0-9_]* (with str methods, faster than a regex). """
+    return name.isascii () and name[:1].isalpha () and name.isidentifier ()
 
 def line_number (ast_node):
     """ Returns line number of an ast_node. """
@@ -38,27 +39,76 @@ def line_number (ast_node):
 class Error (Exception):
     pass
 
+class Node:
+    """
+    Lightweight AST node, replacing grako.ast.AST nodes (see lower) and built by template expansion.
+    Fields are plain attributes ; unset fields read as None, like in grako AST nodes.
+    Nodes are copied through their attribute dict (vars (node)).
+    """
+    def __init__ (self, fields = (), **kwargs):
+        self.__dict__.update (fields, **kwargs)
+    def __getattr__ (self, name):
+        # Only called for unset attributes
+        if name.startswith ("__"): raise AttributeError (name)
+        return None
+
+def lower (ast):
+    """
+    Recursively convert a grako AST (nodes and lists) to Node objects and plain lists.
+    Strings (names, operators, constants) are interned, as they are copied to many expanded nodes.
+    """
+    if isinstance (ast, dict): return Node ((field, lower (value)) for field, value in ast.items ())
+    if isinstance (ast, list): return [lower (e) for e in ast]
+    if type (ast) is str: return sys.intern (ast)
+    return ast
+
 def alter (node, **kwargs):
     """ Copy and update AST node with provided key=value pairs. """
-    new = dict (node)
-    new.update (**kwargs)
-    return grako.ast.AST (new)
+    return Node (vars (node), **kwargs)
 def alter_f (node, context, **funcs):
     """
     Fast copy and update for expressions, calls f(key, context) for all given key=f
     If f returns None, returns None (recursively delete empty constructs)
     """
-    new = dict (node)
     for field, func in funcs.items ():
-        new[field] = func (node[field], context)
-        if new[field] is None:
+        value = func (getattr (node, field), context)
+        if value is None:
             return None
-    return grako.ast.AST (new)
+        funcs[field] = value # funcs is a fresh dict, reused to store the new values
+    # node is only copied if all fields are valid
+    new = Node (vars (node))
+    new.__dict__.update (funcs)
+    return new
 def simplify (l, keep_list = False):
     """ Removes None's elements in a list, and returns None if empty """
-    cleaned = [e for e in l if e is not None]
+    # usual case without None elements : the list is kept as is
+    cleaned = l if None not in l else [e for e in l if e is not None]
     return cleaned if len (cleaned) > 0 or keep_list else None
 
+def normalize (key, value = None):
+    """
+    Normalize a template iterable element to a dict with:
+    - element keys + _key=element_name if iterable was a dict and element was a dict
+    - val=element + _key=element_name if only iterable was a dict
+    - _key=element if iterable was a list
+    """
+    if value is None: normalized = dict ()
+    elif isinstance (value, dict) or isinstance (value, collections.abc.Mapping): normalized = dict (value)
+    else: normalized = dict (value = value)
+    # keys are shared by all instances built on the element
+    normalized["_key"] = sys.intern (key) if type (key) is str else key
+    return normalized
+
+def references_context (ast):
+    """ True if an AST subtree contains templates referencing context elements (key_ref or field_ref). """
+    if isinstance (ast, Node):
+        if ast.key_ref is not None or ast.field_ref is not None:
+            return True
+        return any (references_context (value) for field, value in vars (ast).items () if field != "parseinfo")
+    if isinstance (ast, list):
+        return any (references_context (e) for e in ast)
+    return False
+
 # Text evaluation
 class ExpandedExprTextEval:
     """
@@ -79,17 +129,24 @@ class ExpandedExprTextEval:
     def expr (self, e):
         if e.val is not None: return self.rvalue (e.val)
         if e.op is not None: self.not_allowed ("+/- operations")
+    COMPARISONS = { "=": operator.eq, "<>": operator.ne }
     def comp_expr (self, c):
-        try: func = { "=": operator.eq, "<>": operator.ne }[c.op]
-        except KeyError: self.not_allowed ("{} operations".format (c.op)) 
+        func = self.COMPARISONS.get (c.op)
+        if func is None: self.not_allowed ("{} operations".format (c.op))
         return func (self.expr (c.lhs), self.expr (c.rhs))
     def bool_expr (self, e):
         if e.forall is not None: self.not_allowed ("forall constructs")
         if e.comp is not None: return self.comp_expr (e.comp)
     def and_expr (self, a):
-        return all (map (self.bool_expr, a))
+        bool_expr = self.bool_expr
+        for e in a:
+            if not bool_expr (e): return False
+        return True
     def or_expr (self, o):
-        return any (map (self.and_expr, o))
+        and_expr = self.and_expr
+        for e in o:
+            if and_expr (e): return True
+        return False
 
 # Template instance generator
 class TemplateInstanceGenerator:
@@ -103,12 +160,14 @@ class TemplateInstanceGenerator:
         self.engine = engine
         self.tep = TemplateExprPrinter ()
         self.text_eval = ExpandedExprTextEval ()
+        self.element_cache = {}
+        self.name_formats = {}
+        self.cond_dependencies = {}
+        self.cond_results = {}
 
     # Instance constructors
     def empty (self):
         return tuple ()
-    def single (self, v):
-        return (v,)
 
     # Template expansion
     def expand (self, tpl, context):
@@ -136,18 +195,57 @@ class TemplateInstanceGenerator:
                 line_number (tpl), self.tep.template (tpl), e))
             
     def name (self, name_parts, context):
-        """ Expand a template name. """
+        """
+        Expand a template name, by concatenating name parts and template values.
+        The name is split once per name node in a first part and a list of (template, next part) pairs.
+        """
         try:
-            fmt = "{}".join (name_parts[0::2]) # get name_parts and insert format tokens
-            expanded = [self.expand (tpl, context) for tpl in name_parts[1::2]]
-            name = fmt.format (*expanded)
-            if not NAME_FORMAT.match (name):
+            name_format = self.name_formats.get (id (name_parts))
+            if name_format is None:
+                name_format = self.name_formats[id (name_parts)] = (
+                        name_parts[0], list (zip (name_parts[1::2], name_parts[2::2])))
+            name, tpl_parts = name_format
+            for tpl, part in tpl_parts:
+                name += str (self.expand (tpl, context)) + part
+            if not valid_name (name):
                 raise Error ("malformed: {}".format (name))
-            return name
+            # expanded names are repeated across many statements, share one string per name
+            return sys.intern (name)
         except Error as e:
             raise Error ("in name {}: {}".format (self.tep.name (name_parts), e))
     
     # Template instantiation
+    def depends_on_context (self, cond):
+        """ Whether a template condition references context elements (computed once per condition node). """
+        dependent = self.cond_dependencies.get (id (cond))
+        if dependent is None:
+            dependent = self.cond_dependencies[id (cond)] = references_context (cond)
+        return dependent
+
+    def elements (self, tpl, context):
+        """
+        Expand a template element to the sorted list of normalized elements it iterates on.
+        Element lists are computed once per expanded data object (top-level data, or a field of an element),
+        and cached by object identity (the object is kept in the cache to keep its id valid).
+        """
+        data = self.expand (tpl, context)
+        cached = self.element_cache.get (id (data))
+        if cached is not None:
+            return cached[1]
+
+        # plain dicts and lists (json data) are checked before the slower abstract classes
+        # elements are sorted by key before normalization, to make order predictable
+        if isinstance (data, dict) or isinstance (data, collections.abc.Mapping):
+            elements = [normalize (k, d) for k, d in sorted (data.items ())]
+        elif isinstance (data, list) or isinstance (data, collections.abc.Iterable):
+            elements = [normalize (k) for k in sorted (data)]
+        else:
+            raise Error ("line {}: in template {}: expanded value is not iterable: {}".format (
+                line_number (tpl), self.tep.template (tpl), data))
+
+        self.element_cache[id (data)] = (data, elements)
+        return elements
+
     def instances (self, tpl_decl, context):
         """
         Returns a generator for sub instances formed from a current instance (context) and a template declaration node.
@@ -159,49 +257,59 @@ class TemplateInstanceGenerator:
             yield context
             return
 
-        def normalize (key, value = None):
+        def recursive_generator (tpl_list, ctx, depth = 0):
             """
-            Normalize a template iterable element to a dict with:
-            - element keys + _key=element_name if iterable was a dict and element was a dict
-            - val=element + _key=element_name if only iterable was a dict
-            - _key=element if iterable was a list
+            ctx is a list holding the context followed by the sub instance elements chosen so far.
+            It is extended and restored in place ; sub instances are copied out at the end case only.
             """
-            if value is None: normalized = dict ()
-            elif isinstance (value, collections.Mapping): normalized = dict (value)
-            else: normalized = dict (value = value)
-            normalized["_key"] = key
-            return normalized
-
-        def recursive_generator (tpl_list, ctx):
-            if len (tpl_list) == 0:
-                # end case, return empty instance
-                yield self.empty ()
+            if depth == len (tpl_list):
+                # end case, return the sub instance
+                yield tuple (ctx[len (context):])
                 return
-            # retrieve iterable
-            tpl = tpl_list[0]
-            iterable = self.expand (tpl, ctx)
-            if isinstance (iterable, collections.Mapping):
-                iterable = [normalize (k, d) for k, d in iterable.items ()]
-            elif isinstance (iterable, collections.Iterable):
-                iterable = [normalize (k) for k in iterable]
-            else: 
-                raise Error ("line {}: in template {}: expanded value is not iterable: {}".format (
-                    line_number (tpl), self.tep.template (tpl), iterable))
-            # generate sub_instances (make order predictable)
-            iterable.sort (key = lambda e: e["_key"])
-            for head_ in iterable:
-                head = self.single (head_)
-                for tail in recursive_generator (tpl_list[1:], ctx + head):
-                    yield head + tail
+            for element in self.elements (tpl_list[depth], ctx):
+                ctx.append (element)
+                yield from recursive_generator (tpl_list, ctx, depth + 1)
+                ctx.pop ()
+
+        def product_generator (tpl_list, ctx):
+            """
+            Template elements that do not depend on each other are expanded once.
+            Sub instances are their cartesian product, in the same order as recursive_generator.
+            """
+            element_lists = []
+            for tpl in tpl_list:
+                element_list = self.elements (tpl, ctx)
+                if len (element_list) == 0:
+                    return
+                element_lists.append (element_list)
+            yield from itertools.product (*element_lists)
 
         def eval_cond (context):
-            if tpl_decl.cond is None:
+            cond = tpl_decl.cond
+            if cond is None:
                 return True
-            expanded_cond = self.engine.or_expr (tpl_decl.cond, context)
-            return self.text_eval.or_expr (expanded_cond)
+            result = self.cond_results.get (id (cond))
+            if result is None:
+                expanded_cond = self.engine.or_expr (cond, context)
+                result = self.text_eval.or_expr (expanded_cond)
+                if not self.depends_on_context (cond):
+                    # same result for all instances, evaluated once
+                    self.cond_results[id (cond)] = result
+            return result
         
+        def independent (tpl):
+            """ True if tpl only refers to top-level data or to the current context, not to new sub instance elements. """
+            if tpl.arg is not None:
+                return True
+            index = tpl.key_ref if tpl.key_ref is not None else tpl.field_ref.key
+            return int (index) < len (context)
+
         tpl_args = [] if tpl_decl.args is None else tpl_decl.args
-        for sub_instance in recursive_generator (tpl_args, context):
+        if all (independent (tpl) for tpl in tpl_args):
+            sub_instances = product_generator (tpl_args, context)
+        else:
+            sub_instances = recursive_generator (tpl_args, list (context))
+        for sub_instance in sub_instances:
             instance = context + sub_instance
             if eval_cond (instance):
                 yield instance
@@ -220,17 +328,26 @@ class TemplateEngine:
     Each of these functions follow the prototype <element_name> (<element_node>, <template_context>).
     """
     def __init__ (self, ast):
-        self.ast = ast
+        # converted once, as fields are accessed many times during expansion
+        self.ast = lower (ast)
 
     def run (self, data):
-        self.ig = TemplateInstanceGenerator (self, data)
-        return alter (self.ast,
-                types = self.types (self.ast.types),
-                decls = self.decls (self.ast.decls),
-                init = self.proc_expr_construct (self.ast.init, self.ig.empty ()),
-                invariants = self.proc_expr_construct_list (self.ast.invariants),
-                unsafes = self.proc_expr_construct_list (self.ast.unsafes),
-                transitions = self.transitions (self.ast.transitions))
+        """
+        Expand the template AST with data.
+        Top-level statement lists of the result are generators, expanded while being consumed.
+        They can only be iterated once.
+        Expansion uses a copy of the engine bound to data, so later runs do not affect unconsumed results.
+        """
+        engine = copy.copy (self)
+        engine.ig = TemplateInstanceGenerator (engine, data)
+        ast = engine.ast
+        return alter (ast,
+                types = engine.types (ast.types),
+                decls = engine.decls (ast.decls),
+                init = engine.proc_expr_construct (ast.init, engine.ig.empty ()),
+                invariants = engine.proc_expr_construct_list (ast.invariants),
+                unsafes = engine.proc_expr_construct_list (ast.unsafes),
+                transitions = engine.transitions (ast.transitions))
 
     # Propagate in expressions
     def name (self, n, ctx):
@@ -268,37 +385,47 @@ class TemplateEngine:
         generated = []
         for and_elem in a:
             if and_elem.expr is not None:
-                generated.append (self.bool_expr (and_elem.expr, ctx))
+                bool_expr = self.bool_expr (and_elem.expr, ctx)
+                if bool_expr is not None: generated.append (bool_expr)
             if and_elem.template is not None:
                 for instance in self.ig.instances (and_elem.template.decl, ctx):
-                    generated.extend (self.and_expr (and_elem.template.expr, instance))
+                    and_expr = self.and_expr (and_elem.template.expr, instance)
+                    if and_expr is not None: generated.extend (and_expr)
             if and_elem.or_expr is not None:
                 raise Error ("line {}: nested or expression not allowed here: {}".format (
                     line_number (a), TemplateExprPrinter ().and_expr (a)))
-        return simplify (generated)
+        return generated if len (generated) > 0 else None
     def and_expr_with_nested_or (self, a, ctx):
         """
         AND expressions nested in an OR expr.
         Will be converted to a flattened expanded OR expression (list of AND expression).
         Result is an OR expression to support nested OR expressions that require duplicating the rest of the AND expression.
+        It is generated lazily, one expanded AND expression at a time.
         """
         # templatize and classify and_elements
         bool_expr_list = []
         nested_or_exprs = []
         for and_elem in a:
             if and_elem.expr is not None:
-                bool_expr_list.append (self.bool_expr (and_elem.expr, ctx))
+                bool_expr = self.bool_expr (and_elem.expr, ctx)
+                if bool_expr is not None: bool_expr_list.append (bool_expr)
             if and_elem.template is not None:
                 for instance in self.ig.instances (and_elem.template.decl, ctx):
                     # Templates will call and_expr_with_nested_or, that returns an or_expr
                     nested_or_exprs.append (self.and_expr_with_nested_or (and_elem.template.expr, instance))
             if and_elem.or_expr is not None:
-                nested_or_exprs.append (self.or_expr (and_elem.or_expr, ctx))
-        bool_expr_list = simplify (bool_expr_list, keep_list = True)
-        nested_or_exprs = simplify (nested_or_exprs, keep_list = True)
+                or_expr = self.or_expr (and_elem.or_expr, ctx)
+                if or_expr is not None: nested_or_exprs.append (or_expr)
+        if len (nested_or_exprs) == 0:
+            # plain AND expression, nothing to combine
+            yield bool_expr_list
+            return
         # iterate on all nested_or's and_exprs combinations, combine them with the normal and_expr part
-        return [sum (and_expr_combination_list, bool_expr_list)
-                for and_expr_combination_list in itertools.product (*nested_or_exprs)]
+        for and_expr_combination_list in itertools.product (*nested_or_exprs):
+            combined = list (bool_expr_list)
+            for and_expr in and_expr_combination_list:
+                combined.extend (and_expr)
+            yield combined
 
     def or_expr (self, o, ctx):
         """ OR expression ; will be flattened to a list of expanded AND expressions. """
@@ -309,7 +436,7 @@ class TemplateEngine:
             if or_elem.template is not None:
                 for instance in self.ig.instances (or_elem.template.decl, ctx):
                     generated.extend (self.and_expr_with_nested_or (or_elem.template.expr, instance))
-        return simplify (generated)
+        return generated if len (generated) > 0 else None
 
     # Transitions
     def case (self, c, ctx):
@@ -347,24 +474,24 @@ class TemplateEngine:
         return alter_f (alter (t, require = self.or_expr (t.require, ctx)),
                 ctx, name = self.name, updates = self.update_list)
     def transitions (self, transitions):
+        """ Generates expanded transitions lazily, skipping removed ones. """
         # allow no transition (cubicle error)
-        generated = []
         for t in transitions:
             for instance in self.ig.instances (t.decl, self.ig.empty ()):
-                generated.append (self.transition (t, instance))
-        return simplify (generated, keep_list = True)
+                generated = self.transition (t, instance)
+                if generated is not None: yield generated
     
     # Var declarations
     def decl (self, d, ctx):
         # typename not a template
         return alter_f (d, ctx, name = self.ref)
     def decls (self, decls):
+        """ Generates expanded declarations lazily, skipping removed ones. """
         # allow no declaration (cubicle error)
-        generated = []
         for d in decls:
             for instance in self.ig.instances (d.decl, self.ig.empty ()):
-                generated.append (self.decl (d, instance))
-        return simplify (generated, keep_list = True)
+                generated = self.decl (d, instance)
+                if generated is not None: yield generated
     
     # Type declarations
     def type_enum_list (self, enum_list, ctx):
@@ -380,16 +507,19 @@ class TemplateEngine:
         # typename not a template
         return alter_f (t, ctx, enum = self.type_enum_list)
     def types (self, types):
+        """ Generates expanded type definitions lazily, skipping removed ones. """
         # allow no types
-        return simplify ([self.type_def (t, self.ig.empty ()) for t in types], keep_list = True)
+        for t in types:
+            generated = self.type_def (t, self.ig.empty ())
+            if generated is not None: yield generated
 
     # Init, unsafe and invariant 
     def proc_expr_construct (self, construct, ctx):
         return alter_f (construct, ctx, expr = self.or_expr)
     def proc_expr_construct_list (self, constructs):
-        generated = []
+        """ Generates expanded invariant or unsafe constructs lazily, skipping removed ones. """
         for c in constructs:
             for instance in self.ig.instances (c.decl, self.ig.empty ()):
-                generated.append (self.proc_expr_construct (c, instance))
-        return simplify (generated, keep_list = True)
+                generated = self.proc_expr_construct (c, instance)
+                if generated is not None: yield generated
 